@@ -1,52 +1,251 @@
 import subprocess
-import multiprocessing
 import argparse
+import fnmatch
 import os
 import functools
+import hashlib
 import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Tuple
 
+try:
+    import docker
+except ImportError:
+    docker = None
 
-def is_available_repo(root: str, name: str):
-    return os.path.isdir(os.path.join(root, name)) and not name.startswith(".")
+# One docker client shared by all workers, see `get_docker_client`
+_docker_client = None
+_docker_client_initialized = False
+_docker_client_lock = threading.Lock()
 
 
-def evaluate_repo(path: str, uid: int, gid: int, user: str):
-    repo = os.path.basename(path)
+def get_docker_client():
+    """
+    Return a long-lived docker SDK client talking to the daemon directly, or
+    None if the `docker` package is unavailable or cannot reach the daemon
+    (and the CLI should be used, which also honors the docker CLI contexts).
+    """
+    global _docker_client, _docker_client_initialized
+    if docker is None:
+        return None
+    with _docker_client_lock:
+        if not _docker_client_initialized:
+            _docker_client_initialized = True
+            try:
+                _docker_client = docker.from_env()
+            except docker.errors.DockerException:
+                _docker_client = None
+    return _docker_client
+
+
+# The mypy and baseline caches are shared by all evaluation containers
+CACHE_VOLUME = "typybench-cache"
+
+
+def run_command(commands: list, env: Optional[dict] = None):
+    # Spool outputs to temporary files rather than pipes, so that large docker
+    # logs can neither fill up the pipe buffer nor cost us reads on the way.
+    # The outputs are only reported on failures, so only then are they read.
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        process = subprocess.Popen(
+            commands, stdout=out, stderr=err, bufsize=-1, env=env
+        )
+        return_code = process.wait()
+        if not return_code:
+            return return_code, b"", b""
+        out.seek(0)
+        err.seek(0)
+        return return_code, out.read(), err.read()
 
+
+def run_container(client, image: str, user: Optional[str], mounts: list):
+    """
+    Run the image through the docker SDK like `docker run --rm` does, but keep
+    the container until its logs are read (which are only needed on failures)
+    """
+    container = client.containers.run(
+        image,
+        detach=True,
+        user=user,
+        mounts=mounts,
+        security_opt=["seccomp:unconfined"],
+    )
+    try:
+        return_code = container.wait()["StatusCode"]
+        if not return_code:
+            return return_code, b"", b""
+        stdout = container.logs(stdout=True, stderr=False)
+        stderr = container.logs(stdout=False, stderr=True)
+        return return_code, stdout, stderr
+    finally:
+        container.remove(force=True)
+
+
+def evaluate_repo(paths: Tuple[str, str], uid: int, gid: int, user: str):
+    # The real path is resolved once by `main` rather than by every task
+    path, real_path = paths
+    repo = os.path.basename(path)
+    image = f"typybench-{repo.lower()}"
+    container_user = f"{uid}:{gid}" if sys.platform == "linux" else ""
     commands = [
         "docker",
         "run",
         "-i",
     ]
-    if sys.platform == "linux":
-        commands.extend([f"--user", f"{uid}:{gid}"])
+    if container_user:
+        commands.extend([f"--user", container_user])
     commands.extend(
         [
             f"--rm",
             # fmt: off
-            f"--mount", f"type=bind,source={os.path.realpath(path)},target=/mnt/{repo}",
+            f"--mount", f"type=bind,source={real_path},target=/mnt/{repo}",
+            f"--mount", f"type=volume,source={CACHE_VOLUME},target=/typybench/.cache",
             f"--security-opt", "seccomp:unconfined",
             # fmt: on
-            f"typybench-{repo.lower()}",
+            image,
         ]
     )
 
-    pipe = subprocess.run(
-        commands,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        check=False,
-    )
+    client = get_docker_client()
+    if client is not None:
+        mounts = [
+            docker.types.Mount(f"/mnt/{repo}", real_path, type="bind"),
+            docker.types.Mount("/typybench/.cache", CACHE_VOLUME, type="volume"),
+        ]
+        try:
+            return_code, stdout, stderr = run_container(
+                client, image, container_user or None, mounts
+            )
+        except docker.errors.DockerException as e:
+            return_code, stdout, stderr = 1, b"", str(e).encode()
+    else:
+        return_code, stdout, stderr = run_command(commands)
     return dict(
         path=path,
         repo=repo,
-        stderr=pipe.stderr,
-        stdout=pipe.stdout,
-        return_code=pipe.returncode,
-        commands=pipe.args,
+        stderr=stderr,
+        stdout=stdout,
+        return_code=return_code,
+        commands=commands,
     )
 
 
+def load_dockerignore(context_path: str):
+    """
+    Parse the `.dockerignore` of the build context into a list of
+    `(is_exception, pattern_parts)`, where later patterns take precedence.
+    """
+    patterns = []
+    try:
+        with open(os.path.join(context_path, ".dockerignore"), "r") as reader:
+            lines = reader.read().splitlines()
+    except FileNotFoundError:
+        return patterns
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        is_exception = line.startswith("!")
+        line = os.path.normpath(line.lstrip("!").strip().lstrip("/"))
+        patterns.append((is_exception, line.split(os.sep)))
+    return patterns
+
+
+def is_docker_ignored(parts: List[str], patterns) -> bool:
+    # A pattern excluding a directory also excludes everything under it
+    ignored = False
+    for is_exception, pattern in patterns:
+        if len(pattern) <= len(parts) and all(
+            fnmatch.fnmatchcase(x, y) for x, y in zip(parts, pattern)
+        ):
+            ignored = not is_exception
+    return ignored
+
+
+def may_contain_exceptions(parts: List[str], patterns) -> bool:
+    return any(
+        is_exception
+        and len(pattern) > len(parts)
+        and all(fnmatch.fnmatchcase(x, y) for x, y in zip(parts, pattern))
+        for is_exception, pattern in patterns
+    )
+
+
+def iter_context_files(context_path: str):
+    """Yield the paths of the files that are sent to docker as the build context"""
+    patterns = load_dockerignore(context_path)
+    for root, dirs, files in os.walk(context_path):
+        parts = os.path.relpath(root, context_path).split(os.sep)
+        if parts == ["."]:
+            parts = []
+        dirs[:] = sorted(
+            x
+            for x in dirs
+            if not is_docker_ignored(parts + [x], patterns)
+            or may_contain_exceptions(parts + [x], patterns)
+        )
+        for name in sorted(files):
+            if not is_docker_ignored(parts + [name], patterns):
+                yield os.path.join(root, name)
+
+
+def iter_tree_files(path: str):
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            yield os.path.join(root, name)
+
+
+def update_hash_with_files(sha1, root: str, paths):
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        relpath = os.path.relpath(path, root)
+        sha1.update(f"{relpath}:{stat.st_size}:{stat.st_mtime_ns}\0".encode())
+
+
+def get_build_hash(commands: list, context_path: str, repo_path: str):
+    sha1 = hashlib.sha1()
+    sha1.update("\0".join(commands).encode())
+    with open(os.path.join(context_path, "Dockerfile"), "rb") as reader:
+        sha1.update(reader.read())
+    # The typybench sources are copied into the image as well
+    update_hash_with_files(sha1, context_path, iter_context_files(context_path))
+    sha1.update(b"\0")
+    update_hash_with_files(sha1, repo_path, iter_tree_files(repo_path))
+    return sha1.hexdigest()
+
+
+def get_image_hash(image: str):
+    client = get_docker_client()
+    if client is not None:
+        try:
+            return client.images.get(image).labels.get("typybench.hash")
+        except docker.errors.DockerException:
+            return None
+
+    process = subprocess.run(
+        [
+            "docker",
+            "image",
+            "inspect",
+            "--format",
+            '{{index .Config.Labels "typybench.hash"}}',
+            image,
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    if process.returncode:
+        return None
+    return process.stdout.decode().strip()
+
+
 def build_repo(repo: str, uid: int, gid: int, user: str, data_path: str):
     commands = [
         "docker",
@@ -74,33 +273,52 @@ def build_repo(repo: str, uid: int, gid: int, user: str, data_path: str):
                 # fmt: on
             ]
         )
+    image = f"typybench-{repo.lower()}"
+    repo_path = os.path.join(data_path, repo)
+    context_path = os.path.dirname(os.path.realpath(__file__))
     commands.extend(
         [
             f"--build-context",
-            f"data={os.path.join(data_path, repo)}",
+            f"data={repo_path}",
+            # Reuse the layers of the previously built image
+            f"--cache-from",
+            image,
+            f"--build-arg",
+            f"BUILDKIT_INLINE_CACHE=1",
             f"-t",
-            f"typybench-{repo.lower()}",
-            f"{os.path.dirname(os.path.realpath(__file__))}",
+            image,
         ]
     )
-    pipe = subprocess.run(
-        commands,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        check=False,
+
+    # Skip the build if the image was built from the very same inputs
+    build_hash = get_build_hash(commands, context_path, repo_path)
+    if get_image_hash(image) == build_hash:
+        return dict(
+            repo=repo,
+            stderr=b"",
+            stdout=b"",
+            return_code=0,
+            commands=commands,
+        )
+
+    commands.extend([f"--label", f"typybench.hash={build_hash}", context_path])
+    return_code, stdout, stderr = run_command(
+        commands, env={**os.environ, "DOCKER_BUILDKIT": "1"}
     )
     return dict(
         repo=repo,
-        stderr=pipe.stderr,
-        stdout=pipe.stdout,
-        return_code=pipe.returncode,
-        commands=pipe.args,
+        stderr=stderr,
+        stdout=stdout,
+        return_code=return_code,
+        commands=commands,
     )
 
 
 def main(args):
     available_repos = [
-        x for x in os.listdir(args.data_path) if is_available_repo(args.data_path, x)
+        x.name
+        for x in os.scandir(args.data_path)
+        if not x.name.startswith(".") and x.is_dir()
     ]
     if args.repo is not None:
         if args.repo in available_repos:
@@ -114,19 +332,25 @@ def main(args):
     else:
         mapper = evaluate_repo
         enabled_repos = []
-        for x in os.listdir(args.pred_path):
-            if is_available_repo(args.pred_path, x):
-                if x in available_repos:
-                    enabled_repos.append(os.path.join(args.pred_path, x))
+        available_set = set(available_repos)
+        for x in os.scandir(args.pred_path):
+            if not x.name.startswith(".") and x.is_dir():
+                if x.name in available_set:
+                    enabled_repos.append(x.path)
                 else:
-                    print(f"{x} is not found as a available repo")
+                    print(f"{x.name} is not found as a available repo")
     for x in enabled_repos:
         print(f"-> Found an available repo {x} to evaluate")
+    if not args.build:
+        enabled_repos = [(x, os.path.realpath(x)) for x in enabled_repos]
 
     mapper = functools.partial(mapper, uid=args.uid, gid=args.gid, user=args.user)
-    with multiprocessing.Pool(processes=args.num_workers) as pool:
+    # Workers only wait on docker, hence threads rather than processes
+    with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
         key = "repo" if args.build else "path"
-        for x in pool.imap_unordered(mapper, enabled_repos):
+        futures = [executor.submit(mapper, x) for x in enabled_repos]
+        for future in as_completed(futures):
+            x = future.result()
             if x["return_code"]:
                 print(f"... Failure on {key} {x[key]}")
                 print(f"... commands:\n{x['commands']}\n")
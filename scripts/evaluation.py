@@ -1,11 +1,12 @@
 # usage: python evaluation.py -n <the_repo_name> -p <the_prediction_path_by_model_name>
 #
+import csv
+import math
 import os
 from argparse import ArgumentParser
 from collections import defaultdict
 
 import numpy as np
-import pandas as pd
 import pickle
 
 from typybench.repo_similarity import get_repo_similarity
@@ -14,11 +15,7 @@ import collections
 
 
 def compute_consistency_score(num_errors, num_vars):
-    return np.exp(-num_errors / num_vars * 10)
-
-
-def compute_consistency_score(num_errors, num_vars):
-    return np.exp(-num_errors / num_vars * 10)
+    return math.exp(-num_errors / num_vars * 10)
 
 
 def get_data_by_dict(score_dict, result):
@@ -42,37 +39,29 @@ def get_data_by_dict(score_dict, result):
     else:
         repo_overall_score_wo_missing = 0
 
-    score_by_depth = defaultdict(list)
-    # collect occurance of each type
-    type_to_scores = defaultdict(list)
-    for var_name, score in score_dict.items():
+    # meta data contains "mypy_type"
+    # take the string representation of the mypy_type to be the type lable
+    depths = []
+    label_ids = []
+    label_to_id = {}
+    for var_name in score_dict:
         type_meta_data = result.a_meta_dict[var_name]
-        depth = min(type_meta_data.depth, 5)
-        score_by_depth[depth].append(score)
-        # meta data contains "mypy_type"
-        # take the string representation of the mypy_type to be the type lable
+        depths.append(min(type_meta_data.depth, 5))
         type_label = str(type_meta_data.mypy_type)
-        type_to_scores[type_label].append(score)
-
-    # Get the type label with count lower than 5
-    # and get the average score of these types
-    type_to_count = {k: len(v) for k, v in type_to_scores.items()}
-    # filter out the labels with count less than 5
-    lower_than_5 = [k for k, v in type_to_count.items() if v < 5]
-    lower_than_5_average = sum(
-        [
-            sum(type_to_scores[type_label]) / len(type_to_scores[type_label])
-            for type_label in lower_than_5
-        ]
-    ) / len(lower_than_5)
-    # filter out the labels with count less than 10
-    lower_than_10 = [k for k, v in type_to_count.items() if v < 10]
-    lower_than_10_average = sum(
-        [
-            sum(type_to_scores[type_label]) / len(type_to_scores[type_label])
-            for type_label in lower_than_10
-        ]
-    ) / len(lower_than_10)
+        label_ids.append(label_to_id.setdefault(type_label, len(label_to_id)))
+    scores = np.fromiter(score_dict.values(), dtype=np.float64, count=len(score_dict))
+    depths = np.asarray(depths, dtype=np.int8)
+    label_ids = np.asarray(label_ids, dtype=np.int64)
+
+    score_by_depth = defaultdict(list)
+    for depth in np.unique(depths):
+        score_by_depth[int(depth)] = scores[depths == depth].tolist()
+
+    # Get the average score of the type labels with count lower than 5 and 10
+    type_counts = np.bincount(label_ids)
+    type_averages = np.bincount(label_ids, weights=scores) / type_counts
+    lower_than_5_average = float(type_averages[type_counts < 5].mean())
+    lower_than_10_average = float(type_averages[type_counts < 10].mean())
 
     return (
         repo_overall_score,
@@ -89,8 +78,29 @@ def get_average_score(scores):
     return sum(scores) / len(scores)
 
 
+def save_scores_by_depth(filename, **scores_by_depth):
+    arrays = {}
+    for name, c in scores_by_depth.items():
+        for depth, scores in c.items():
+            arrays[f"{name}_{depth}"] = np.asarray(scores, dtype=np.float64)
+    np.savez(filename, **arrays)
+
+
+def load_scores_by_depth(filename, *names):
+    results = {name: defaultdict(list) for name in names}
+    with np.load(filename) as arrays:
+        for key in arrays.files:
+            name, depth = key.rsplit("_", 1)
+            results[name][int(depth)] = arrays[key]
+    return tuple(results[name] for name in names)
+
+
 def evaluate(path_to_repo, path_to_pred_folder):
     filename_result = os.path.join(args.pred_path, f"{args.repo_name}_result_dict.pkl")
+    # The scores by depth are stored as arrays aside from the pickled results
+    filename_depth_scores = os.path.join(
+        args.pred_path, f"{args.repo_name}_result_depth_scores.npz"
+    )
 
     if os.path.exists(filename_result):
         print(f"Result exists, reading...")
@@ -104,10 +114,12 @@ def evaluate(path_to_repo, path_to_pred_folder):
 
         repo_overall_score = data["repo_overall_score"]
         repo_overall_score_wo_missing = data["repo_overall_score_wo_missing"]
-        c = data["c"]
         repo_overall_score_exact = data["repo_overall_score_exact"]
         repo_overall_score_wo_missing_exact = data["repo_overall_score_wo_missing"]
-        c_exact = data["c_exact"]
+        if "c" in data:  # results cached before the scores were split out
+            c, c_exact = data["c"], data["c_exact"]
+        else:
+            c, c_exact = load_scores_by_depth(filename_depth_scores, "c", "c_exact")
         lower_than_5_average = data["lower_than_5_average"]
         lower_than_10_average = data["lower_than_10_average"]
         lower_than_5_average_exact = data["lower_than_5_average_exact"]
@@ -144,22 +156,23 @@ def evaluate(path_to_repo, path_to_pred_folder):
         result.b_meta_dict.clear()
 
         print("Saving Results...")
+        # The pickled results mark the cache as complete, so they go last
+        save_scores_by_depth(filename_depth_scores, c=c, c_exact=c_exact)
         with open(filename_result, "wb") as f1:
             pickle.dump(
                 {
                     "result": result,
                     "repo_overall_score": repo_overall_score,
                     "repo_overall_score_wo_missing": repo_overall_score_wo_missing,
-                    "c": c,
                     "repo_overall_score_exact": repo_overall_score_exact,
                     "repo_overall_score_wo_missing_exact": repo_overall_score_wo_missing_exact,
-                    "c_exact": c_exact,
                     "lower_than_5_average": lower_than_5_average,
                     "lower_than_10_average": lower_than_10_average,
                     "lower_than_5_average_exact": lower_than_5_average_exact,
                     "lower_than_10_average_exact": lower_than_10_average_exact,
                 },
                 f1,
+                protocol=pickle.HIGHEST_PROTOCOL,
             )
 
     print(
@@ -190,35 +203,38 @@ def evaluate(path_to_repo, path_to_pred_folder):
             f"Depth {depth} has {len(scores)} variables with average exact score {get_average_score(scores)}"
         )
 
-    df = pd.DataFrame(
-        {
-            "repo_name": [args.repo_name],
-            "total_vars": [len(score_dict)],
-            "overall_score": [repo_overall_score],
-            "overall_score_wo_missing": [repo_overall_score_wo_missing],
-            "overall_score_exact": [repo_overall_score_exact],
-            "overall_score_wo_missing_exact": [repo_overall_score_wo_missing_exact],
-            "missing_ratio": [len(missing_vars) / len(score_dict)],
-            "depth_1_score": [get_average_score(c[1])],
-            "depth_2_score": [get_average_score(c[2])],
-            "depth_3_score": [get_average_score(c[3])],
-            "depth_4_score": [get_average_score(c[4])],
-            "depth_5_score": [get_average_score(c[5])],
-            "depth_1_score_exact": [get_average_score(c_exact[1])],
-            "depth_2_score_exact": [get_average_score(c_exact[2])],
-            "depth_3_score_exact": [get_average_score(c_exact[3])],
-            "depth_4_score_exact": [get_average_score(c_exact[4])],
-            "depth_5_score_exact": [get_average_score(c_exact[5])],
-            "repo_a_consistency": [result.a_repo_stat["filtered_errors_count"]],
-            "repo_b_consistency": [result.b_repo_stat["filtered_errors_count"]],
-            "lower_than_5_average": [lower_than_5_average],
-            "lower_than_10_average": [lower_than_10_average],
-            "lower_than_5_average_exact": [lower_than_5_average_exact],
-            "lower_than_10_average_exact": [lower_than_10_average_exact],
-        }
-    )
+    row = {
+        "repo_name": args.repo_name,
+        "total_vars": len(score_dict),
+        "overall_score": repo_overall_score,
+        "overall_score_wo_missing": repo_overall_score_wo_missing,
+        "overall_score_exact": repo_overall_score_exact,
+        "overall_score_wo_missing_exact": repo_overall_score_wo_missing_exact,
+        "missing_ratio": len(missing_vars) / len(score_dict),
+        "depth_1_score": get_average_score(c[1]),
+        "depth_2_score": get_average_score(c[2]),
+        "depth_3_score": get_average_score(c[3]),
+        "depth_4_score": get_average_score(c[4]),
+        "depth_5_score": get_average_score(c[5]),
+        "depth_1_score_exact": get_average_score(c_exact[1]),
+        "depth_2_score_exact": get_average_score(c_exact[2]),
+        "depth_3_score_exact": get_average_score(c_exact[3]),
+        "depth_4_score_exact": get_average_score(c_exact[4]),
+        "depth_5_score_exact": get_average_score(c_exact[5]),
+        "repo_a_consistency": result.a_repo_stat["filtered_errors_count"],
+        "repo_b_consistency": result.b_repo_stat["filtered_errors_count"],
+        "lower_than_5_average": lower_than_5_average,
+        "lower_than_10_average": lower_than_10_average,
+        "lower_than_5_average_exact": lower_than_5_average_exact,
+        "lower_than_10_average_exact": lower_than_10_average_exact,
+    }
     output_file = os.path.join(args.pred_path, f"{args.repo_name}_results_w_exact.csv")
-    df.to_csv(output_file, index=False, float_format=lambda x: f"{x:.4f}")
+    with open(output_file, "w", newline="") as writer:
+        csv_writer = csv.writer(writer, lineterminator="\n")
+        csv_writer.writerow(row.keys())
+        csv_writer.writerow(
+            f"{x:.4f}" if isinstance(x, float) else x for x in row.values()
+        )
     print(f"Result is saved to {output_file}")
 
 
@@ -1,12 +1,24 @@
 import requests
 import ast
+import base64
+import io
 import json
+import re
+import subprocess
+import tempfile
+import tokenize
 from typing import List, Tuple, Optional
 import os
 import argparse
 
+from requests.adapters import HTTPAdapter
+
 BASE_URL = "https://api.github.com"
 
+# A shared session keeps the connections to GitHub alive across requests
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
 
 def get_github_token(token: Optional[str] = None):
     if token is not None:
@@ -21,117 +33,210 @@ def extract_repo_info(repo_url: str) -> Tuple[str, str]:
     return owner, repo
 
 
+def clone_repository(owner: str, repo: str, target: str, *, github_token: str):
+    # A shallow clone fetches the whole tree at once instead of one request per
+    # directory and file through the contents API
+    credentials = base64.b64encode(f"x-access-token:{github_token}".encode())
+    # Pass the token through the environment rather than the command line, where
+    # it would be visible to other users
+    env = {
+        **os.environ,
+        "GIT_CONFIG_COUNT": "1",
+        "GIT_CONFIG_KEY_0": "http.extraHeader",
+        "GIT_CONFIG_VALUE_0": f"Authorization: Basic {credentials.decode()}",
+    }
+    subprocess.run(
+        [
+            "git",
+            "clone",
+            "--quiet",
+            "--depth=1",
+            f"https://github.com/{owner}/{repo}",
+            target,
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        env=env,
+    )
+
+
+def read_source(path: str) -> str:
+    with open(path, "rb") as reader:
+        data = reader.read()
+    # Honor the coding cookie of the file as Python does, but never fail on
+    # undecodable files
+    try:
+        encoding, _ = tokenize.detect_encoding(io.BytesIO(data).readline)
+    except SyntaxError:
+        encoding = "utf-8"
+    return data.decode(encoding, errors="replace")
+
+
 def get_files_in_directory(
-    owner: str,
-    repo: str,
+    root: str,
     path: str = "",
     depth: int = 0,
     max_depth: int = 3,
-    *,
-    github_token: str,
 ) -> List[str]:
-    url = f"{BASE_URL}/repos/{owner}/{repo}/contents/{path}"
-    headers = {"Authorization": f"token {github_token}"}
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    items = response.json()
+    entries = sorted(os.scandir(os.path.join(root, path)), key=lambda x: x.name)
 
     files = []
-    for item in items:
-        if item["type"] == "file" and item["name"].endswith(".py"):
-            files.append(item["path"])
-        elif item["type"] == "dir" and depth < max_depth:
-            files.extend(
-                get_files_in_directory(
-                    owner,
-                    repo,
-                    item["path"],
-                    depth + 1,
-                    max_depth,
-                    github_token=github_token,
-                )
-            )
+    for entry in entries:
+        item_path = f"{path}/{entry.name}" if path else entry.name
+        if entry.is_file(follow_symlinks=False) and entry.name.endswith(".py"):
+            files.append(item_path)
+        elif (
+            entry.is_dir(follow_symlinks=False)
+            and entry.name != ".git"
+            and depth < max_depth
+        ):
+            files.extend(get_files_in_directory(root, item_path, depth + 1, max_depth))
 
     return files
 
 
-def fetch_file_content(
-    owner: str, repo: str, file_path: str, *, github_token: str
-) -> str:
-    url = f"{BASE_URL}/repos/{owner}/{repo}/contents/{file_path}"
-    headers = {"Authorization": f"token {github_token}"}
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    file_content = requests.get(response.json()["download_url"]).text
-    return file_content
+# The next closing parenthesis, skipping whitespace, comments and line breaks
+_CLOSING_PARENTHESIS_PATTERN = re.compile(rb"(?:\s|\\|#[^\n]*)*\)")
+
+
+class FunctionAnnotationCounter(ast.NodeVisitor):
+    def __init__(self, file_path: str, file_content: str):
+        self.file_path = file_path
+        # AST positions are given as (line number, utf-8 byte offset)
+        self.source = file_content.encode()
+        self.line_offsets = [0]
+        for match in re.finditer(b"\n", self.source):
+            self.line_offsets.append(match.end())
+        self.total_functions = 0
+        self.annotated_functions = 0
+        self.functions_with_defaults = 0
+        self.total_annotations = 0
+        self.function_names = []
+        self.modified_functions = []
+
+    def generic_visit(self, node: ast.AST):
+        # Functions can only be defined by statements, so there is no need to
+        # descend into any expressions
+        for field in ("body", "orelse", "finalbody", "handlers", "cases"):
+            for child in getattr(node, field, ()):
+                self.visit(child)
+
+    def visit_FunctionDef(self, node: ast.FunctionDef):
+        self.total_functions += 1
+        self.function_names.append(node.name)
+        has_default = len(node.args.defaults) > 0
+
+        # Count typing information and locate it in the source at once
+        annotations_count = 0
+        annotation_spans = []
+        for arg in node.args.args:
+            if arg.annotation:
+                annotations_count += 1
+                start = self.get_offset(arg.lineno, arg.col_offset)
+                start += len(arg.arg.encode())
+                annotation_spans.append(
+                    (start, self.get_end_offset(start, arg.annotation))
+                )
+        if node.returns:
+            annotations_count += 1
+            start = self.source.rfind(
+                b"->",
+                self.get_offset(node.lineno, node.col_offset),
+                self.get_offset(node.returns.lineno, node.returns.col_offset),
+            )
+            end = self.get_end_offset(start, node.returns)
+            while self.source[start - 1 : start] in (b" ", b"\t"):
+                start -= 1
+            annotation_spans.append((start, end))
+
+        if annotations_count > 0:
+            self.annotated_functions += 1
+        self.total_annotations += annotations_count
+        if has_default:
+            self.functions_with_defaults += 1
+
+        # Store the function with its typing information removed
+        self.modified_functions.append(
+            {
+                "name": node.name,
+                "modified_function": self.get_source_without(node, annotation_spans),
+                "path": self.file_path,
+            }
+        )
+        self.generic_visit(node)
+
+    def get_offset(self, lineno: int, col_offset: int) -> int:
+        return self.line_offsets[lineno - 1] + col_offset
+
+    def get_end_offset(self, start: int, annotation: ast.expr) -> int:
+        """
+        Get the end of an annotation starting after `start`, including the
+        closing parentheses of any parentheses it is wrapped in
+        """
+        position = self.get_offset(annotation.end_lineno, annotation.end_col_offset)
+        # Only the opening parentheses, whitespace and comments can appear
+        # between the colon (or arrow) and the annotation
+        prefix = self.source[
+            start : self.get_offset(annotation.lineno, annotation.col_offset)
+        ]
+        depth = re.sub(rb"#[^\n]*", b"", prefix).count(b"(")
+        while depth > 0:
+            match = _CLOSING_PARENTHESIS_PATTERN.match(self.source, position)
+            position = match.end()
+            depth -= 1
+        return position
+
+    def get_source_without(
+        self, node: ast.FunctionDef, spans: List[Tuple[int, int]]
+    ) -> str:
+        # Slice the function (with its decorators) out of the source rather than
+        # regenerating it with `ast.unparse`, which is far more expensive
+        first = node.decorator_list[0] if node.decorator_list else node
+        position = self.line_offsets[first.lineno - 1]
+        chunks = []
+        for start, end in spans:
+            chunks.append(self.source[position:start])
+            position = end
+        end = self.get_offset(node.end_lineno, node.end_col_offset)
+        chunks.append(self.source[position:end])
+
+        lines = b"".join(chunks).decode().split("\n")
+        indent = lines[0][: len(lines[0]) - len(lines[0].lstrip())]
+        return "\n".join(x[len(indent) :] if x.startswith(indent) else x for x in lines)
 
 
 def count_functions_with_annotations(
     file_content: str, file_path: str
 ) -> Tuple[int, int, int, int, float, List[str], List[dict]]:
     tree = ast.parse(file_content)
-    total_functions = 0
-    annotated_functions = 0
-    functions_with_defaults = 0
-    total_annotations = 0
-    function_names = []
-    modified_functions = []
-
-    for node in ast.walk(tree):
-        if isinstance(node, ast.FunctionDef):
-            total_functions += 1
-            function_names.append(node.name)
-            has_annotation = False
-            has_default = len(node.args.defaults) > 0
-            annotations_count = sum(1 for arg in node.args.args if arg.annotation) + (
-                1 if node.returns else 0
-            )
-            if annotations_count > 0:
-                annotated_functions += 1
-            total_annotations += annotations_count
-            if has_default:
-                functions_with_defaults += 1
-
-            # Remove typing information and store the modified function
-            modified_node = remove_typing_information(node)
-            modified_functions.append(
-                {
-                    "name": node.name,
-                    "modified_function": ast.unparse(modified_node),
-                    "path": file_path,
-                }
-            )
+    counter = FunctionAnnotationCounter(file_path, file_content)
+    counter.visit(tree)
 
+    total_functions = counter.total_functions
+    total_annotations = counter.total_annotations
     average_annotations = total_annotations / total_functions if total_functions else 0
     return (
         total_functions,
-        annotated_functions,
-        functions_with_defaults,
+        counter.annotated_functions,
+        counter.functions_with_defaults,
         total_annotations,
         average_annotations,
-        function_names,
-        modified_functions,
+        counter.function_names,
+        counter.modified_functions,
     )
 
 
-def remove_typing_information(node: ast.FunctionDef) -> ast.FunctionDef:
-    for arg in node.args.args:
-        arg.annotation = None
-    if node.returns:
-        node.returns = None
-    return node
-
-
 def get_repo_details(owner: str, repo: str, *, github_token: str) -> dict:
     url = f"{BASE_URL}/repos/{owner}/{repo}"
     headers = {"Authorization": f"token {github_token}"}
-    response = requests.get(url, headers=headers)
+    response = SESSION.get(url, headers=headers)
     response.raise_for_status()
     repo_info = response.json()
 
     # Get the latest commit hash
     commits_url = f"{BASE_URL}/repos/{owner}/{repo}/commits"
-    commits_response = requests.get(commits_url, headers=headers)
+    commits_response = SESSION.get(commits_url, headers=headers)
     commits_response.raise_for_status()
     latest_commit = commits_response.json()[0]["sha"]
 
@@ -147,12 +252,16 @@ def analyze_repository(repo_url: str, *, github_token: str) -> dict:
     owner, repo = extract_repo_info(repo_url)
     try:
         repo_details = get_repo_details(owner, repo, github_token=github_token)
-        files = get_files_in_directory(
-            owner,
-            repo,
-            max_depth=1,
-            github_token=github_token,
-        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            clone_repository(owner, repo, temp_dir, github_token=github_token)
+            files = get_files_in_directory(temp_dir, max_depth=1)
+            results = []
+            for file_path in files:
+                file_content = read_source(os.path.join(temp_dir, file_path))
+                results.append(
+                    count_functions_with_annotations(file_content, file_path)
+                )
+
         total_files = len(files)
         total_functions = 0
         total_annotated_functions = 0
@@ -161,11 +270,7 @@ def analyze_repository(repo_url: str, *, github_token: str) -> dict:
         all_function_names = []
         all_modified_functions = []
 
-        for file_path in files:
-            file_content = fetch_file_content(
-                owner, repo, file_path, github_token=github_token
-            )
-            result = count_functions_with_annotations(file_content, file_path)
+        for result in results:
             (
                 functions,
                 annotated_functions,
@@ -203,6 +308,8 @@ def analyze_repository(repo_url: str, *, github_token: str) -> dict:
 
     except requests.exceptions.HTTPError as err:
         return {"repository": repo_url, "error": str(err)}
+    except subprocess.CalledProcessError as err:
+        return {"repository": repo_url, "error": err.stderr.decode().strip()}
 
 
 def main(args):
@@ -1,12 +1,14 @@
-__all__ = ["get_type_dict_from_code", "get_type_dict_from_repo", "is_valid_python_file"]
+__all__ = [
+    "get_cache_root",
+    "get_type_dict_from_code",
+    "get_type_dict_from_repo",
+    "is_valid_python_file",
+]
 
 import ast
 import os
-import pathlib
-import shutil
-import sys
-import tempfile
-from typing import Dict, Optional, List
+import re
+from typing import Dict, Optional, List, Set
 
 import mypy.nodes
 import mypy.types
@@ -15,6 +17,21 @@ from mypy import build
 from mypy.build import BuildSource
 from mypy.options import Options
 
+# Module attributes generated by Python itself rather than the repo's code
+_DUNDER_NAMES = frozenset(
+    (
+        "__name__",
+        "__doc__",
+        "__file__",
+        "__package__",
+        "__spec__",
+        "__annotations__",
+        "__path__",
+        "__match_args__",
+        "__dataclass_fields__",
+    )
+)
+
 
 def is_valid_python_code(code: str) -> bool:
     try:
@@ -26,7 +43,6 @@ def is_valid_python_code(code: str) -> bool:
 
 def is_valid_python_file(path: str) -> bool:
     with open(path, "r") as reader:
-        print("path:", path)
         return is_valid_python_code(reader.read())
 
 
@@ -77,7 +93,11 @@ def remove_duplicated_files(paths: List[str]):
     return results
 
 
-def filter_errors(error_data: dict):
+def is_repo_path(path: str, repo_path: str) -> bool:
+    return path.startswith(os.path.join(repo_path, ""))
+
+
+def filter_errors(error_data: dict, repo_path: str):
     keep_keys = ["attr-defined", "assignment", "arg-type", "union-attr", "index"]
     filtered_keys = "others"
     keyword = "incompatible"
@@ -90,7 +110,7 @@ def filter_errors(error_data: dict):
         # If the key is one of the keys to keep, add it directly to the filtered data
         if key in keep_keys:
             for message in value["messages"]:
-                if message.startswith("/tmp"):
+                if is_repo_path(message, repo_path):
                     if key not in filtered_data:
                         filtered_data[key] = {"count": 0, "messages": []}
                     filtered_data[key]["messages"].append(message)
@@ -98,7 +118,7 @@ def filter_errors(error_data: dict):
         # Check the messages for the "incompatible" keyword and add them to "others"
         elif "messages" in value:
             for message in value["messages"]:
-                if keyword in message and message.startswith("/tmp"):
+                if keyword in message and is_repo_path(message, repo_path):
                     if filtered_keys not in filtered_data:
                         filtered_data[filtered_keys] = {"count": 0, "messages": []}
                     filtered_data[filtered_keys]["messages"].append(message)
@@ -107,6 +127,13 @@ def filter_errors(error_data: dict):
     return filtered_data
 
 
+# Matches `file_path:line_number: error: message [error-code]` in one go, where
+# the error code (within the last square brackets) is optional
+_MYPY_ERROR_PATTERN = re.compile(
+    r"^([^:]*):([^:]*):.*?error:\s*(.*?)(?:\s*\[([^\[]*)\])?\s*$"
+)
+
+
 def analyze_mypy_errors(errors: List[str]):
     # Expected mypy error format:
     # file_path:line_number: error: message [error-code]
@@ -115,44 +142,41 @@ def analyze_mypy_errors(errors: List[str]):
 
     error_data = {}
     for line in errors:
-        # Split the line into parts
-        try:
-            # Split by colon to separate file, line, and the rest
-            file_part, line_part, error_part = line.split(":", 2)
-
-            # Further split the error_part to get the message and error code
-            if "error:" in error_part:
-                _, message_with_code = error_part.split("error:", 1)
-                message_with_code = message_with_code.strip()
-
-                # Extract the error code within square brackets
-                if "[" in message_with_code and message_with_code.endswith("]"):
-                    message, error_code = message_with_code.rsplit("[", 1)
-                    message = message.strip()
-                    error_code = error_code[:-1]  # Remove the closing bracket
-                else:
-                    # If no error code is present, categorize under 'unknown'
-                    message = message_with_code
-                    error_code = "unknown"
+        match = _MYPY_ERROR_PATTERN.match(line)
+        if match is None:
+            # If the line doesn't match the expected format, skip it
+            continue
+        file_part, line_part, message, error_code = match.groups()
+        if error_code is None:
+            # If no error code is present, categorize under 'unknown'
+            error_code = "unknown"
 
-                # Initialize the error type in the dictionary if not present
-                if error_code not in error_data:
-                    error_data[error_code] = {"count": 0, "messages": []}
+        # Initialize the error type in the dictionary if not present
+        if error_code not in error_data:
+            error_data[error_code] = {"count": 0, "messages": []}
 
-                # Prepare the full error line
-                full_error_line = (
-                    f"{file_part}:{line_part}: error: {message} [{error_code}]"
-                )
+        # Prepare the full error line
+        full_error_line = f"{file_part}:{line_part}: error: {message} [{error_code}]"
 
-                # Increment the count and append the full error line
-                error_data[error_code]["count"] += 1
-                error_data[error_code]["messages"].append(full_error_line)
-        except ValueError:
-            # If the line doesn't match the expected format, skip it
-            continue
+        # Increment the count and append the full error line
+        error_data[error_code]["count"] += 1
+        error_data[error_code]["messages"].append(full_error_line)
     return error_data
 
 
+def collect_python_files(path: str):
+    # Collect both the code and stub files in a single walk of the tree
+    python_code_files = []
+    python_stub_files = []
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name.endswith(".py"):
+                python_code_files.append(os.path.join(root, name))
+            elif name.endswith(".pyi"):
+                python_stub_files.append(os.path.join(root, name))
+    return python_code_files, python_stub_files
+
+
 def find_python_modules(repo_path: str, base_path: Optional[str] = None):
     if base_path is None:
         base_path = repo_path
@@ -162,8 +186,7 @@ def find_python_modules(repo_path: str, base_path: Optional[str] = None):
         path = os.path.join(repo_path, path)
         if os.path.isdir(path):
             if os.path.exists(os.path.join(path, "__init__.py")):
-                python_code_files = list(map(str, pathlib.Path(path).rglob("*.py")))
-                python_stub_files = list(map(str, pathlib.Path(path).rglob("*.pyi")))
+                python_code_files, python_stub_files = collect_python_files(path)
                 modules[path] = remove_duplicated_files(
                     python_code_files + python_stub_files
                 )
@@ -174,80 +197,151 @@ def find_python_modules(repo_path: str, base_path: Optional[str] = None):
     return modules
 
 
-def is_submodule(a: str, b: str):
-    a = a.split(".")
-    b = b.split(".")
+def get_cache_root() -> str:
+    """
+    Get the directory of the caches kept across runs, which can be moved with
+    the `TYPYBENCH_CACHE_DIR` environment variable (e.g. onto a docker volume).
+    """
+    cache_root = os.environ.get("TYPYBENCH_CACHE_DIR")
+    if cache_root:
+        return cache_root
+    return os.path.join(os.path.expanduser("~"), ".cache", "typybench")
+
+
+def get_cache_dir() -> str:
+    """
+    Get the mypy cache directory shared by all repo builds, such that the
+    standard library and the dependencies are only checked once. Mypy itself
+    validates the cached modules against the sources.
+    """
+    return os.path.join(get_cache_root(), "mypy")
 
-    for i, e in enumerate(b):
-        if i >= len(a) or e != a[i]:
-            return False
-    return True
+
+def get_repo_snapshot(python_modules: Dict[str, List[str]]) -> tuple:
+    snapshot = []
+    for file_paths in python_modules.values():
+        for path in file_paths:
+            stat = os.stat(path)
+            snapshot.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(sorted(snapshot))
+
+
+def count_errors(e):
+    r = 0
+    for x in e.values():
+        r += x["count"]
+    return r
+
+
+# The result of the latest repo build along with the repo path and the snapshot
+# of the files it was built from. Only one is kept, as the types hold on to the
+# whole build.
+_last_repo_build: Optional[tuple] = None
 
 
 def get_type_dict_from_repo(repo_path: str, return_stat: bool = False):
+    global _last_repo_build
+    # Absolute paths are needed to tell the errors of the repo files apart
+    repo_path = os.path.abspath(repo_path)
     python_modules = find_python_modules(repo_path)
+
+    # Reuse the previous build of the repo if none of its files changed since
+    snapshot = get_repo_snapshot(python_modules)
+    if _last_repo_build is not None and _last_repo_build[:2] == (repo_path, snapshot):
+        _, _, type_info, stat = _last_repo_build
+    else:
+        # Release the previous build before starting another one
+        _last_repo_build = None
+        type_info, stat = build_type_dict_from_repo(repo_path, python_modules)
+        _last_repo_build = (repo_path, snapshot, type_info, stat)
+
+    # Hand out copies so that callers cannot modify the cached results
+    if return_stat:
+        return dict(type_info), dict(stat)
+    else:
+        return dict(type_info)
+
+
+def get_repo_build_options(repo_path: str, skipped_modules: Set[str]) -> Options:
+    options = Options()
+    options.no_site_packages = True
+    options.no_silence_site_packages = True
+    options.show_absolute_path = True
+    options.incremental = True
+    options.cache_dir = get_cache_dir()
+    options.fixed_format_cache = True
+    # The baseline is built in another process at the same time, and unlike the
+    # SQLite store, the file system store writes every cache file atomically
+    options.sqlite_cache = False
+    # Tolerate unresolved imports rather than following them
+    options.follow_imports = "silent"
+    options.ignore_missing_imports = True
+    # The dropped repo files are still on disk, so never follow imports into them
+    for module in skipped_modules:
+        options.per_module_options[module] = {"follow_imports": "skip"}
+    return options
+
+
+def build_type_dict_from_repo(repo_path: str, python_modules: Dict[str, List[str]]):
     python_files = []
     valid_python_files = []
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        sources = []
-        for module_path, file_paths in python_modules.items():
-            for path in map(str, file_paths):
-                relpath = os.path.relpath(path, repo_path)
-                module = get_module_name_from_path(relpath)
-                if module.startswith("."):  # ignore any packages start with a dot
-                    continue
+    sources = []
+    skipped_modules = set()
+    for module_path, file_paths in python_modules.items():
+        for path in map(str, file_paths):
+            relpath = os.path.relpath(path, repo_path)
+            module = get_module_name_from_path(relpath)
+            if module.startswith("."):  # ignore any packages start with a dot
+                continue
 
-                python_files.append(path)
-                if not is_valid_python_file(path):
+            python_files.append(path)
+            try:
+                with open(path, "r") as reader:
+                    text = reader.read()
+                ast.parse(text)
+            except (OSError, SyntaxError, ValueError):
+                logger.warning(f"Ignore file {path} as it is not a valid python file")
+                skipped_modules.add(module)
+                continue
+
+            # Let mypy read the file itself, as it only consults its incremental
+            # cache for sources given without text
+            sources.append(BuildSource(path=path, module=module, base_dir=repo_path))
+
+    while True:
+        options = get_repo_build_options(repo_path, skipped_modules)
+        try:
+            result = build.build(sources=sources, options=options)
+            break
+        except mypy.build.CompileError as e:
+            # Drop all offending files reported by this build at once
+            path_to_delete = dict()
+            for x in e.messages:
+                path, line, *_ = x.split(":")
+                if is_repo_path(path, repo_path):
+                    path_to_delete.setdefault(path, x)
+            if not path_to_delete:
+                raise
+
+            remaining_sources = []
+            for source in sources:
+                if source.path in path_to_delete:
                     logger.warning(
-                        f"Ignore file {path} as it is not a valid python file"
+                        f"Ignore file {source.path} "
+                        f"as it compiles with error: {path_to_delete.pop(source.path)}"
                     )
-                    continue
+                    skipped_modules.add(source.module)
+                else:
+                    remaining_sources.append(source)
+            if path_to_delete:
+                raise FileNotFoundError(
+                    f"Cannot find the corresponding file to delete: {next(iter(path_to_delete))}"
+                ) from e
+            sources = remaining_sources
 
-                temp_path = os.path.join(temp_dir, relpath)
-                os.makedirs(os.path.dirname(temp_path), exist_ok=True)
-                shutil.copyfile(path, temp_path)
-                source = BuildSource(path=temp_path, module=module, base_dir=temp_dir)
-                sources.append(source)
-
-        options = Options()
-        options.no_site_packages = True
-        options.no_silence_site_packages = True
-        options.incremental = False
-        while True:
-            try:
-                result = build.build(sources=sources, options=options)
-                break
-            except mypy.build.CompileError as e:
-                path_to_delete = dict()
-                for x in e.messages:
-                    path, line, *_ = x.split(":")
-                    if path.startswith("/tmp"):
-                        path = os.path.relpath(path, temp_dir)
-                        path_to_delete[path] = x
-                for path, message in path_to_delete.items():
-                    found = False
-                    for i in range(len(sources)):
-                        source_path = os.path.relpath(sources[i].path, temp_dir)
-                        if source_path == path:
-                            logger.warning(
-                                f"Ignore file {path} "
-                                f"as it compiles with error: {message}"
-                            )
-                            os.remove(os.path.join(temp_dir, path))
-                            sources.pop(i)
-                            found = True
-                            break
-                    if not found:
-                        raise FileNotFoundError(
-                            f"Cannot find the corresponding file to delete: {os.path.join(temp_dir, path)}"
-                        ) from e
-
-        for source in sources:
-            valid_python_files.append(
-                os.path.join(repo_path, os.path.relpath(source.path, temp_dir))
-            )
+    for source in sources:
+        valid_python_files.append(source.path)
 
     errors = dict()
     if result.errors:
@@ -259,65 +353,37 @@ def get_type_dict_from_repo(repo_path: str, return_stat: bool = False):
     for m in result.files.values():
         type_info.update(get_type_dict_from_symbol_table(m.names))
 
-    repo_modules = [
-        get_module_name_from_path(os.path.relpath(m, repo_path)) for m in python_modules
-    ]
-    modules = list(type_info.keys())
-    for key in modules:
-        module = key
-        module = module.split("::")[0]
-        module = module.split("@")[0]
-        if module.split(".")[-1] in (
-            "__name__",
-            "__doc__",
-            "__file__",
-            "__package__",
-            "__spec__",
-            "__annotations__",
-            "__path__",
-            "__match_args__",
-            "__dataclass_fields__",
+    # A module belongs to the repo if any of its prefixes is a repo module
+    repo_modules = {
+        tuple(get_module_name_from_path(os.path.relpath(m, repo_path)).split("."))
+        for m in python_modules
+    }
+    for key in list(type_info):
+        module_parts = tuple(key.split("::", 1)[0].split("@", 1)[0].split("."))
+        if module_parts[-1] in _DUNDER_NAMES or not any(
+            module_parts[:i] in repo_modules for i in range(1, len(module_parts) + 1)
         ):
-            type_info.pop(key)
-            continue
-
-        is_repo_module = False
-        for repo_module in repo_modules:
-            if is_submodule(module, repo_module):
-                is_repo_module = True
-                break
-        if not is_repo_module:
-            type_info.pop(key)
-
-    if return_stat:
-
-        def count_errors(e):
-            r = 0
-            for x in e.values():
-                r += x["count"]
-            return r
-
-        filtered_errors = filter_errors(errors)
-        stat = {
-            "python_files": python_files,
-            "valid_python_files": valid_python_files,
-            "invalid_python_files": [
-                path for path in python_files if path not in valid_python_files
-            ],
-            "errors": errors,
-            "errors_count": count_errors(filtered_errors),
-            "filtered_errors": filtered_errors,
-            "filtered_errors_count": count_errors(filtered_errors),
-        }
-        return type_info, stat
-    else:
-        return type_info
+            del type_info[key]
+
+    filtered_errors = filter_errors(errors, repo_path)
+    valid_python_file_set = set(valid_python_files)
+    stat = {
+        "python_files": python_files,
+        "valid_python_files": valid_python_files,
+        "invalid_python_files": [
+            path for path in python_files if path not in valid_python_file_set
+        ],
+        "errors": errors,
+        "errors_count": count_errors(filtered_errors),
+        "filtered_errors": filtered_errors,
+        "filtered_errors_count": count_errors(filtered_errors),
+    }
+    return type_info, stat
 
 
 def get_type_dict_from_code(code: str):
     sources = [BuildSource("main", "__main__", text=code)]
     options = Options()
-    options.modules = list(sys.modules.values())
     result = build.build(sources=sources, options=options)
     type_info = {}
     for module in result.files.values():
@@ -326,46 +392,59 @@ def get_type_dict_from_code(code: str):
     return type_info
 
 
+# Nodes that carry no type annotations of their own
+_SKIPPED_NODE_TYPES = frozenset(
+    (
+        mypy.nodes.Decorator,
+        mypy.nodes.OverloadedFuncDef,
+        mypy.nodes.TypeVarExpr,
+        mypy.nodes.ParamSpecExpr,
+        mypy.nodes.TypeVarTupleExpr,
+        mypy.nodes.MypyFile,
+    )
+)
+
+
 def get_type_dict_from_symbol_table(table: Dict[str, mypy.nodes.SymbolTableNode]):
     type_info = {}
-    for name, node in table.items():
-        if isinstance(node.node, mypy.nodes.TypeInfo):  # A new class
-            type_info.update(get_type_dict_from_symbol_table(node.node.names))
-        elif isinstance(node.node, mypy.nodes.Var) and node.node.type is not None:
-            type_info[node.fullname] = node.node.type
-        elif isinstance(node.node, mypy.nodes.FuncDef):
-            if hasattr(node.node, "arguments"):
-                for arg in node.node.arguments:
-                    arg = arg.variable
-                    if arg.type is None:
-                        continue
-                    type_info[f"{node.fullname}@{arg.name}"] = arg.type
-            elif node.node.type is not None:
-                for arg_name, arg_type in zip(
-                    node.node.arg_names, node.node.type.arg_types
-                ):
-                    type_info[f"{node.fullname}@{arg_name}"] = arg_type
-
-            if node.node.type is not None:
-                type_info[f"{node.fullname}::return"] = node.node.type.ret_type
-        elif isinstance(node.node, mypy.nodes.TypeAlias):
-            type_info[node.fullname] = node.node.target
-        elif isinstance(
-            node.node,
-            (
-                mypy.nodes.Decorator,
-                mypy.nodes.OverloadedFuncDef,
-                mypy.nodes.TypeVarExpr,
-                mypy.nodes.ParamSpecExpr,
-                mypy.nodes.TypeVarTupleExpr,
-            ),
-        ):
-            pass
-        elif isinstance(node.node, mypy.nodes.MypyFile):
-            pass
+    # Nested classes are visited depth-first, in the same order as they appear.
+    # Classes can import each other, so each class is only visited once.
+    seen = set()
+    stack = [iter(table.items())]
+    while stack:
+        for name, node in stack[-1]:
+            if isinstance(node.node, mypy.nodes.TypeInfo):  # A new class
+                if id(node.node) in seen:
+                    continue
+                seen.add(id(node.node))
+                stack.append(iter(node.node.names.items()))
+                break
+            elif isinstance(node.node, mypy.nodes.Var) and node.node.type is not None:
+                type_info[node.fullname] = node.node.type
+            elif isinstance(node.node, mypy.nodes.FuncDef):
+                if hasattr(node.node, "arguments"):
+                    for arg in node.node.arguments:
+                        arg = arg.variable
+                        if arg.type is None:
+                            continue
+                        type_info[f"{node.fullname}@{arg.name}"] = arg.type
+                elif node.node.type is not None:
+                    for arg_name, arg_type in zip(
+                        node.node.arg_names, node.node.type.arg_types
+                    ):
+                        type_info[f"{node.fullname}@{arg_name}"] = arg_type
+
+                if node.node.type is not None:
+                    type_info[f"{node.fullname}::return"] = node.node.type.ret_type
+            elif isinstance(node.node, mypy.nodes.TypeAlias):
+                type_info[node.fullname] = node.node.target
+            elif type(node.node) in _SKIPPED_NODE_TYPES:
+                pass
+            else:
+                logger.warning(
+                    f"Ignore Mypy Node: {type(node.node)}\n"  #
+                    f"  Fullname: {node.fullname}"
+                )
         else:
-            logger.warning(
-                f"Ignore Mypy Node: {type(node.node)}\n"  #
-                f"  Fullname: {node.fullname}"
-            )
+            stack.pop()
     return type_info
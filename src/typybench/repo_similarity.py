@@ -3,10 +3,15 @@ __all__ = [
 ]
 
 import dataclasses
-import os.path
-from typing import Optional
+import hashlib
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import FrozenSet, Optional
 
 import mypy.types
+import mypy.version
 
 from .helpers import *
 from .type_similarity import *
@@ -23,40 +28,103 @@ class RepoSimilarity:
     missing_vars: set
 
 
-def compare_type_info(a_type_dict, b_type_dict, baseline_type_dict):
+def get_typed_var_names(repo_path: str) -> FrozenSet[str]:
+    """
+    Get the names of the variables which are not typed as `Any` in the repo.
+    Unlike the types themselves, the names can be sent across processes.
+    """
+    type_dict = get_type_dict_from_repo(repo_path=repo_path)
+    return frozenset(
+        k for k, v in type_dict.items() if not isinstance(v, mypy.types.AnyType)
+    )
+
+
+# Bump whenever the typed variable names collected for a repo could change
+_BASELINE_CACHE_VERSION = 1
+
+
+def get_tree_hash(repo_path: str) -> str:
+    """
+    Hash the file names, sizes and modification times under the repo, which
+    changes whenever any of its files is modified.
+    """
+    digest = hashlib.sha1(os.path.realpath(repo_path).encode())
+    stack = [repo_path]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            entries = sorted(it, key=lambda x: x.name)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                relpath = os.path.relpath(entry.path, repo_path)
+                line = f"{relpath}\0{stat.st_size}\0{stat.st_mtime_ns}\n"
+                digest.update(line.encode())
+    return digest.hexdigest()
+
+
+def get_baseline_cache_path(repo_path: str) -> str:
+    # The names also depend on the mypy version, on how typybench filters the
+    # types of the repo, and on the Python version and the installed packages
+    # (e.g. stubs) of the environment mypy runs in
+    digest = hashlib.sha1(
+        f"{_BASELINE_CACHE_VERSION}\0{mypy.version.__version__}\0"
+        f"{sys.version_info[:2]}\0{sys.prefix}\0".encode()
+    )
+    digest.update(get_tree_hash(repo_path).encode())
+    return os.path.join(get_cache_root(), f"baseline-{digest.hexdigest()}.pkl")
+
+
+def load_typed_var_names(cache_path: str) -> Optional[FrozenSet[str]]:
+    try:
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def save_typed_var_names(cache_path: str, typed_vars: FrozenSet[str]):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # Write to a temporary file first so that concurrent runs never read a
+    # partially written cache
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(typed_vars, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+
+def compare_type_info(a_type_dict, b_type_dict, baseline_typed_vars):
     score_dict = {}
     exact_match_score_dict = {}
     a_meta_dict = {}
     b_meta_dict = {}
     missing_vars = set()
-    for var_name in a_type_dict:
-        if isinstance(a_type_dict[var_name], mypy.types.AnyType):
+    for var_name, a_type in a_type_dict.items():
+        if var_name in baseline_typed_vars:
             continue
-        if var_name in baseline_type_dict and not isinstance(
-            baseline_type_dict[var_name], mypy.types.AnyType
-        ):
+        if isinstance(a_type, mypy.types.AnyType):
             continue
 
         try:
-            a_meta_dict[var_name] = get_mypy_type_meta(a_type_dict[var_name])
+            a_meta_dict[var_name] = get_mypy_type_meta(a_type)
         except SkippedType:
             continue
 
+        b_type = b_type_dict.get(var_name)
         var_name_in_b_dict = False
         try:
-            if var_name in b_type_dict:
-                b_meta_dict[var_name] = get_mypy_type_meta(b_type_dict[var_name])
+            if b_type is not None:
+                b_meta_dict[var_name] = get_mypy_type_meta(b_type)
                 var_name_in_b_dict = True
         except SkippedType:
             pass
 
         if var_name_in_b_dict:
-            var_score = get_type_similarity(
-                a_type=a_type_dict[var_name], b_type=b_type_dict[var_name]
-            )
+            var_score = get_type_similarity(a_type=a_type, b_type=b_type)
             score_dict[var_name] = var_score
             exact_match_score_dict[var_name] = int(
-                str(a_type_dict[var_name]) == str(b_type_dict[var_name])
+                get_type_str(a_type) == get_type_str(b_type)
             )
         else:
             score_dict[var_name] = 0
@@ -88,20 +156,37 @@ def get_repo_similarity(
     if os.path.isdir(os.path.join(b_repo_path, "lib")):
         b_repo_path = os.path.join(b_repo_path, "lib")
 
-    a_type_dict, a_repo_stat = get_type_dict_from_repo(
-        repo_path=a_repo_path, return_stat=True
-    )
-    b_type_dict, b_repo_stat = get_type_dict_from_repo(
-        repo_path=b_repo_path, return_stat=True
-    )
-    baseline_type_dict = get_type_dict_from_repo(repo_path=base_line_repo_path)
-    score_dict, exact_match_score_dict, a_meta_dict, b_meta_dict, missing_vars = (
-        compare_type_info(
-            a_type_dict=a_type_dict,
-            b_type_dict=b_type_dict,
-            baseline_type_dict=baseline_type_dict,
+    # The baseline is usually shared by many comparisons, so its result is
+    # kept on disk until any of its files changes
+    baseline_cache_path = get_baseline_cache_path(base_line_repo_path)
+    baseline_typed_vars = load_typed_var_names(baseline_cache_path)
+
+    # Mypy types cannot be pickled, thus only the baseline build (of which only
+    # the names are needed) runs in another process alongside the other two
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        baseline_future = None
+        if baseline_typed_vars is None:
+            baseline_future = executor.submit(get_typed_var_names, base_line_repo_path)
+        a_type_dict, a_repo_stat = get_type_dict_from_repo(
+            repo_path=a_repo_path, return_stat=True
         )
-    )
+        b_type_dict, b_repo_stat = get_type_dict_from_repo(
+            repo_path=b_repo_path, return_stat=True
+        )
+        if baseline_future is not None:
+            baseline_typed_vars = baseline_future.result()
+            save_typed_var_names(baseline_cache_path, baseline_typed_vars)
+    try:
+        score_dict, exact_match_score_dict, a_meta_dict, b_meta_dict, missing_vars = (
+            compare_type_info(
+                a_type_dict=a_type_dict,
+                b_type_dict=b_type_dict,
+                baseline_typed_vars=baseline_typed_vars,
+            )
+        )
+    finally:
+        # Do not keep the compared types alive beyond this comparison
+        clear_type_caches()
 
     result = RepoSimilarity(
         score_dict=score_dict,
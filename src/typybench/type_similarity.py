@@ -4,21 +4,53 @@ __all__ = [
     "_get_type_info_similarity",
     "SkippedType",
     "get_mypy_type_meta",
+    "get_type_str",
+    "clear_type_caches",
 ]
 
 import dataclasses
+import itertools
+from typing import Optional
 
 import mypy.nodes
 import mypy.types
 import numpy as np
 from loguru import logger
-from scipy.optimize import linear_sum_assignment
+
+# The attributes of the special types never change, so collect them once
+_ANY_ATTRS = frozenset(dir(mypy.types.Any))
+_NONE_ATTRS = frozenset(dir(None))
+_TUPLE_ATTRS = frozenset(dir(tuple))
+
+# Unions up to this width are matched without `linear_sum_assignment`
+_MAX_EXHAUSTIVE_MATCHING_SIZE = 4
 
 
 class SkippedType(RuntimeError):
     pass
 
 
+# Memoized results keyed by the ids of the compared objects. The similarity and
+# meta caches only live during a top-level call (so that the ids stay valid),
+# while the other caches keep the compared objects alive alongside until they
+# are cleared by `clear_type_caches`.
+_similarity_cache: Optional[dict] = None
+_meta_cache: Optional[dict] = None
+_type_info_similarity_cache: dict = {}
+_type_str_cache: dict = {}
+_type_attributes_cache: dict = {}
+
+
+def clear_type_caches():
+    """
+    Release the types kept alive by the caches shared across comparisons, and
+    with them the mypy builds they belong to.
+    """
+    _type_info_similarity_cache.clear()
+    _type_str_cache.clear()
+    _type_attributes_cache.clear()
+
+
 @dataclasses.dataclass
 class TypeMeta(object):
     depth: int
@@ -31,16 +63,42 @@ class TypeMeta(object):
         return self
 
 
+def get_type_str(t: mypy.types.Type) -> str:
+    """
+    Get the (memoized) string representation of a type. Building it traverses
+    the whole type, while the same types are compared over and over again. The
+    cache keeps the type alive so that its id cannot be reused.
+    """
+    cached = _type_str_cache.get(id(t))
+    if cached is None:
+        cached = _type_str_cache[id(t)] = (t, str(t))
+    return cached[1]
+
+
 def get_mypy_type_meta(t: mypy.types.Type):
-    meta = TypeMeta(depth=1, count=0, mypy_type=t)
-    if isinstance(t, mypy.types.UnionType):
-        for x in t.items:
-            meta += get_mypy_type_meta(x)
-    else:
-        type_name, type_origin, type_args = analyze_mypy_type(t)
-        for x in type_args:
-            meta += get_mypy_type_meta(x)
-    meta.count += 1
+    global _meta_cache
+    if _meta_cache is not None:
+        return _get_mypy_type_meta_cached(t)
+    _meta_cache = {}
+    try:
+        return _get_mypy_type_meta_cached(t)
+    finally:
+        _meta_cache = None
+
+
+def _get_mypy_type_meta_cached(t: mypy.types.Type):
+    meta = _meta_cache.get(id(t))
+    if meta is None:
+        meta = TypeMeta(depth=1, count=0, mypy_type=t)
+        if isinstance(t, mypy.types.UnionType):
+            for x in t.items:
+                meta += _get_mypy_type_meta_cached(x)
+        else:
+            type_name, type_origin, type_args = analyze_mypy_type(t)
+            for x in type_args:
+                meta += _get_mypy_type_meta_cached(x)
+        meta.count += 1
+        _meta_cache[id(t)] = meta
     return meta
 
 
@@ -48,18 +106,25 @@ def get_type_attributes(t):
     if isinstance(t, mypy.nodes.TypeInfo):
         return t.names
     elif t == mypy.types.AnyType:
-        return dir(mypy.types.Any)
+        return _ANY_ATTRS
     elif t == mypy.types.NoneType:
-        return dir(None)
+        return _NONE_ATTRS
     elif t == mypy.types.TupleType:
-        return dir(tuple)
+        return _TUPLE_ATTRS
     else:
         raise NotImplementedError(f"{t}: {type(t)}")
 
 
+def get_type_attribute_set(t) -> frozenset:
+    cached = _type_attributes_cache.get(id(t))
+    if cached is None:
+        cached = _type_attributes_cache[id(t)] = (t, frozenset(get_type_attributes(t)))
+    return cached[1]
+
+
 def compare_type_attributes(a_type: mypy.nodes.TypeInfo, b_type: mypy.nodes.TypeInfo):
-    type1_attributes = set(get_type_attributes(a_type))
-    type2_attributes = set(get_type_attributes(b_type))
+    type1_attributes = get_type_attribute_set(a_type)
+    type2_attributes = get_type_attribute_set(b_type)
 
     type1_minus_type2 = type1_attributes - type2_attributes
     type2_minus_type1 = type2_attributes - type1_attributes
@@ -69,33 +134,79 @@ def compare_type_attributes(a_type: mypy.nodes.TypeInfo, b_type: mypy.nodes.Type
 
 
 def _get_type_info_similarity(a_type: mypy.nodes.TypeInfo, b_type: mypy.nodes.TypeInfo):
-    a_b, b_a, common = compare_type_attributes(a_type, b_type)
-    numerator = len(a_b) + len(b_a)
-    denominator = len(common - set(dir(mypy.types.Any))) + len(a_b) + len(b_a)
+    key = (id(a_type), id(b_type))
+    cached = _type_info_similarity_cache.get(key)
+    if cached is None:
+        score = _compute_type_info_similarity(a_type, b_type)
+        cached = _type_info_similarity_cache[key] = (a_type, b_type, score)
+    return cached[2]
+
+
+def _compute_type_info_similarity(
+    a_type: mypy.nodes.TypeInfo, b_type: mypy.nodes.TypeInfo
+):
+    a_attributes = get_type_attribute_set(a_type)
+    b_attributes = get_type_attribute_set(b_type)
+    # The attributes in either type only, and the ones in both types
+    numerator = len(a_attributes ^ b_attributes)
+    denominator = len((a_attributes & b_attributes) - _ANY_ATTRS) + numerator
     if denominator == 0 and numerator == 0:
         return 1.0
     return 1.0 - numerator / denominator
 
 
+def match_exhaustively(cost_matrix: np.ndarray):
+    """
+    Find the matching with the maximum total score by trying out all of them.
+    This is only meant for small matrices (e.g. `Optional[X]`), where it is
+    cheaper than setting up `linear_sum_assignment`.
+    """
+    m, n = cost_matrix.shape
+    costs = cost_matrix.tolist() if m <= n else cost_matrix.T.tolist()
+    best_score, best_match = -1.0, ()
+    for match in itertools.permutations(range(max(m, n)), min(m, n)):
+        score = sum(row[j] for row, j in zip(costs, match))
+        if score > best_score:
+            best_score, best_match = score, match
+    if m <= n:
+        return np.arange(m), np.asarray(best_match, dtype=np.intp)
+    else:
+        return np.asarray(best_match, dtype=np.intp), np.arange(n)
+
+
 def compare_within_level(a_list, b_list, is_union: bool, debug: bool = False):
     if debug:
         logger.debug(f"Compare within level: {a_list}, {b_list}\n")
 
     if is_union:
-        cost_matrix = np.empty([len(b_list), len(a_list)])
-
+        # Identical types are always fully similar, so only the remaining
+        # pairs need the (recursive) similarity computation
+        a_strs = [get_type_str(x) for x in a_list]
+        b_strs = [get_type_str(x) for x in b_list]
+        scores = []
         for i in range(len(b_list)):
             for j in range(len(a_list)):
                 if debug:
                     logger.debug(f"Compare {b_list[i]} with {a_list[j]}")
-                cost_matrix[i, j] = get_type_similarity(b_list[i], a_list[j])
+                if a_strs[j] == b_strs[i]:
+                    scores.append(1.0)
+                else:
+                    scores.append(get_type_similarity(b_list[i], a_list[j]))
+        cost_matrix = np.asarray(scores, dtype=np.float64).reshape(
+            len(b_list), len(a_list)
+        )
 
         if debug:
             logger.debug(
                 f"Formulate a matching problem with the following cost matrix:\n{cost_matrix}"
             )
 
-        match_1, match_2 = linear_sum_assignment(-cost_matrix)
+        if max(cost_matrix.shape) <= _MAX_EXHAUSTIVE_MATCHING_SIZE:
+            match_1, match_2 = match_exhaustively(cost_matrix)
+        else:
+            from scipy.optimize import linear_sum_assignment
+
+            match_1, match_2 = linear_sum_assignment(-cost_matrix)
         score = cost_matrix[match_1, match_2].sum()
 
         if debug:
@@ -148,6 +259,29 @@ def analyze_mypy_type(t: mypy.types.Type):
 
 def get_type_similarity(
     a_type: mypy.types.Type, b_type: mypy.types.Type, debug: bool = False
+):
+    global _similarity_cache
+    if _similarity_cache is not None:  # a recursive call
+        return _get_type_similarity_cached(a_type, b_type, debug)
+    _similarity_cache = {}
+    try:
+        return _get_type_similarity_cached(a_type, b_type, debug)
+    finally:
+        _similarity_cache = None
+
+
+def _get_type_similarity_cached(
+    a_type: mypy.types.Type, b_type: mypy.types.Type, debug: bool = False
+):
+    key = (id(a_type), id(b_type))
+    score = _similarity_cache.get(key)
+    if score is None:
+        score = _similarity_cache[key] = _get_type_similarity(a_type, b_type, debug)
+    return score
+
+
+def _get_type_similarity(
+    a_type: mypy.types.Type, b_type: mypy.types.Type, debug: bool = False
 ):
     assert a_type is not None
     assert b_type is not None
@@ -187,7 +321,7 @@ def get_type_similarity(
             f"  Arguments:     {b_type_args}"
         )
 
-    if str(a_type) == str(b_type):
+    if get_type_str(a_type) == get_type_str(b_type):
         score = 1.0
     else:
         score = _get_type_info_similarity(a_type_origin, b_type_origin)